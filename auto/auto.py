@@ -1,15 +1,21 @@
-#!/usr/bin/env python
-
-from __future__ import print_function
+#!/usr/bin/env python3
 
 from clang.cindex import *
+from concurrent.futures import ProcessPoolExecutor
+import ctypes
+import functools
 import os
+import re
 import sys
 
 ###############################################################################
 # Parsing
 
+# Splits array type like "int [2][3]" to base type and dimensions.
+ARRAY_DIMENSION_REGEX = re.compile(r"(.*?)\s*((?:\[[^\]]*\])*)$", re.DOTALL)
+
 
+@functools.lru_cache(maxsize=None)
 def formatAndCleanType(type):
     """
     Format data type to code style closer to what we want.
@@ -25,13 +31,9 @@ def mergeTypeAndVariable(type, variable):
     """
     Combines type and variable to a single line of code.
     """
-    dimension = ""
-    type = type.strip()
-    while type.endswith(']'):
-        index = type.rfind('[')
-        dimension = type[index:] + dimension
-        type = type[:index]
-    return "{} {}{}". format(type.strip(), variable, dimension)
+    match = ARRAY_DIMENSION_REGEX.match(type.strip())
+    type, dimension = match.groups()
+    return f"{type} {variable}{dimension}"
 
 class Argument:
     """
@@ -44,9 +46,11 @@ class Argument:
         """
         self.name = cursor.spelling
         self.type = formatAndCleanType(cursor.type.spelling)
+        # Declaration is used by multiple generators, so only merge it once.
+        self.declaration = mergeTypeAndVariable(self.type, self.name)
 
     def __str__(self):
-        return mergeTypeAndVariable(self.type, self.name)
+        return self.declaration
 
 
 class Function:
@@ -57,58 +61,69 @@ class Function:
         """
         Construct higher level function declaration from CLang's cursor.
         """
-        self.return_type = "void"
         self.name = cursor.spelling
         self.return_type = formatAndCleanType(cursor.result_type.spelling)
+        PARM_DECL = CursorKind.PARM_DECL
         self.arguments = []
+        add_argument = self.arguments.append
         for child in cursor.get_children():
-            if child.kind == CursorKind.PARM_DECL:
-                self.arguments.append(Argument(child))
+            if child.kind == PARM_DECL:
+                add_argument(Argument(child))
+        self.arguments_declaration = ", ".join(
+                argument.declaration for argument in self.arguments)
+        # Function typedefs separate arguments with a bare comma.
+        self.arguments_typedef = ",".join(
+                argument.declaration for argument in self.arguments)
+        self.argument_names = ", ".join(
+                argument.name for argument in self.arguments)
 
     def __str__(self):
-        result = "{} {}" . format(self.return_type, self.name)
-        for argument in self.arguments:
-            result += "\n" + str(argument)
-        return result
+        lines = [f"{self.return_type} {self.name}"]
+        lines.extend(argument.declaration for argument in self.arguments)
+        return "\n".join(lines)
 
 
 def combine_struct_or_union_decl(cursor):
     """
     Combine structure/union definition to a code snippet.
     """
-    code = cursor.spelling + " {\n"
+    FIELD_DECL = CursorKind.FIELD_DECL
+    lines = [f"{cursor.spelling} {{"]
+    add_line = lines.append
     for child in cursor.get_children():
-        if child.kind == CursorKind.FIELD_DECL:
-            code += "  {};\n" . format(
-                mergeTypeAndVariable(formatAndCleanType(child.type.spelling),
-                                     child.spelling))
-    return code + "}"
+        if child.kind == FIELD_DECL:
+            field_type = formatAndCleanType(child.type.spelling)
+            field = mergeTypeAndVariable(field_type, child.spelling)
+            add_line(f"  {field};")
+    lines.append("}")
+    return "\n".join(lines)
 
 
 def combine_struct_decl(cursor):
     """
     Combine structure definition to a code snippet.
     """
-    return "struct " + combine_struct_or_union_decl(cursor)
+    return f"struct {combine_struct_or_union_decl(cursor)}"
 
 
 def combine_union_decl(cursor):
     """
     Combine structure definition to a code snippet.
     """
-    return "union " + combine_struct_or_union_decl(cursor)
+    return f"union {combine_struct_or_union_decl(cursor)}"
 
 
 def combine_enum_decl(cursor):
     """
     Combine structure definition to a code snippet.
     """
-    code = "enum "  + format(cursor.spelling) + " {\n"
+    ENUM_CONSTANT_DECL = CursorKind.ENUM_CONSTANT_DECL
+    lines = [f"enum {cursor.spelling} {{"]
     for child in cursor.get_children():
-        if child.kind == CursorKind.ENUM_CONSTANT_DECL:
-            code += "  {} = {},\n" . format(child.spelling, child.enum_value)
-    code += "}"
-    return code
+        if child.kind == ENUM_CONSTANT_DECL:
+            lines.append(f"  {child.spelling} = {child.enum_value},")
+    lines.append("}")
+    return "\n".join(lines)
 
 
 class TypeDefinition:
@@ -119,73 +134,112 @@ class TypeDefinition:
         """
         Construct higher level function declaration from CLang's cursor.
         """
+        STRUCT_DECL = CursorKind.STRUCT_DECL
+        UNION_DECL = CursorKind.UNION_DECL
+        ENUM_DECL = CursorKind.ENUM_DECL
+        TYPE_REF = CursorKind.TYPE_REF
         self.name = cursor.spelling
         self.type = None
         for child in cursor.get_children():
-            if child.kind == CursorKind.STRUCT_DECL:
+            # Kind is resolved via CursorKind.from_id() on every access.
+            kind = child.kind
+            if kind == STRUCT_DECL:
                 self.type = combine_struct_decl(child)
-            elif child.kind == CursorKind.UNION_DECL:
+            elif kind == UNION_DECL:
                 self.type = combine_union_decl(child)
-            elif child.kind == CursorKind.ENUM_DECL:
+            elif kind == ENUM_DECL:
                 self.type = combine_enum_decl(child)
-            elif child.kind == CursorKind.TYPE_REF:
+            elif kind == TYPE_REF:
                 self.type = child.spelling
         if self.type is None:
             self.type = formatAndCleanType(cursor.type.get_canonical().spelling)
 
     def __str__(self):
-        return "typedef {} {}" .format(self.type, self.name)
+        return f"typedef {self.type} {self.name}"
 
 
-def collect_function_prototypes(tu):
-    file_name = tu.cursor.spelling
-    functions = []
-    for cursor in tu.cursor.walk_preorder():
-        # Skip all tokens which are coming from different file.
-        if cursor.location.file is None:
-            continue
-        if cursor.location.file.name != file_name:
-            continue
-        if cursor.kind == CursorKind.FUNCTION_DECL:
-            functions.append(Function(cursor))
-    return functions
+def get_file_handle(file):
+    """
+    Get underlying libclang handle of the file.
+
+    Handles are stable for the lifetime of a translation unit, which makes
+    them cheap keys for caching per-file results.
+    """
+    return ctypes.cast(file.obj, ctypes.c_void_p).value
 
 
-def collect_types(tu):
+def combine_macro_definition(cursor):
+    """
+    Combine macro definition to a single line of code.
+
+    Whitespace between tokens is collapsed to a single space and comments are
+    dropped, which keeps function-like macros intact.
+    """
+    parts = ["#define "]
+    previous_end = None
+    for token in cursor.get_tokens():
+        extent = token.extent
+        if previous_end is not None and extent.start.offset > previous_end:
+            parts.append(" ")
+        parts.append(token.spelling)
+        previous_end = extent.end.offset
+    return "".join(parts)
+
+
+def collect_declarations(tu):
+    """
+    Collect function prototypes, type definitions and XCB defines in a single
+    AST walk.
+
+    All of them only appear at the translation unit scope, so there is no
+    need to descend into function bodies, parameters or fields.
+    """
     file_name = tu.cursor.spelling
+    # Maps file handle to whether it refers to the parsed file, so file name
+    # is only queried and compared once per handle.
+    is_own_file = {}
+    FUNCTION_DECL = CursorKind.FUNCTION_DECL
+    TYPEDEF_DECL = CursorKind.TYPEDEF_DECL
+    MACRO_DEFINITION = CursorKind.MACRO_DEFINITION
+    functions = []
     types = []
-    for cursor in tu.cursor.walk_preorder():
+    defines = []
+    # Bind methods once, the loop below goes over every top-level cursor.
+    add_function = functions.append
+    add_type = types.append
+    add_define = defines.append
+    for cursor in tu.cursor.get_children():
         # Skip all tokens which are coming from different file.
-        if cursor.location.file is None:
+        location_file = cursor.location.file
+        if location_file is None:
             continue
-        if cursor.location.file.name != file_name:
+        file_handle = get_file_handle(location_file)
+        own_file = is_own_file.get(file_handle)
+        if own_file is None:
+            own_file = location_file.name == file_name
+            is_own_file[file_handle] = own_file
+        if not own_file:
             continue
-        if cursor.kind == CursorKind.TYPEDEF_DECL:
-            types.append(TypeDefinition(cursor))
-    return types
-
+        kind = cursor.kind
+        if kind == FUNCTION_DECL:
+            add_function(Function(cursor))
+        elif kind == TYPEDEF_DECL:
+            add_type(TypeDefinition(cursor))
+        elif kind == MACRO_DEFINITION and cursor.spelling.startswith("XCB"):
+            add_define(combine_macro_definition(cursor))
+    return functions, types, defines
 
-def collect_defines(file_name):
-    """
-    Collect all XCB defines from file.
-    """
-    defines = []
-    with open(file_name, "r") as f:
-        for line in f.readlines():
-            line = line.strip()
-            if not line.startswith("#define XCB"):
-                continue
-            defines.append(line)
-    return defines
 
 def parse_file(file_name):
     idx = Index.create()
     args = ('-x', 'c-header')
-    tu = idx.parse(file_name, args=args)
-    functions = collect_function_prototypes(tu)
-    types = collect_types(tu)
-    defines = collect_defines(file_name)
-    return functions, types, defines
+    # Function bodies are never looked at, so don't have them in the AST.
+    # Macro definitions are needed for defines, so keep them in the AST.
+    options = (TranslationUnit.PARSE_SKIP_FUNCTION_BODIES |
+               TranslationUnit.PARSE_INCOMPLETE |
+               TranslationUnit.PARSE_DETAILED_PROCESSING_RECORD)
+    tu = idx.parse(file_name, args=args, options=options)
+    return collect_declarations(tu)
 
 
 ###############################################################################
@@ -196,79 +250,47 @@ def generate_function_typedefs(functions):
     Generate typedef for functions:
       typedef return_type (*tMyFunction)(arguments).
     """
-    lines = []
     for function in functions:
-        line = "typedef {} (*t{}) ({});" . format(
-                function.return_type,
-                function.name,
-                ",".join(str(arg) for arg in function.arguments))
-        lines.append(line)
-    return lines
+        arguments = function.arguments_typedef
+        yield (f"typedef {function.return_type} (*t{function.name}) "
+               f"({arguments});")
 
 
 def generate_extern_function_declarations(functions):
     """
     Generate lines "extern tFoo foo_impl;"
     """
-    lines = []
     for function in functions:
-        line = "extern t{} {}_impl;" . format(
-                function.name,
-                function.name,
-                ",".join(str(arg) for arg in function.arguments))
-        lines.append(line)
-    return lines
+        yield f"extern t{function.name} {function.name}_impl;"
 
 
 def generate_extern_function_definitions(functions):
     """
     Generate lines "tFoo foo_impl;"
     """
-    lines = []
     for function in functions:
-        line = "t{} {}_impl;" . format(
-                function.name,
-                function.name,
-                ",".join(str(arg) for arg in function.arguments))
-        lines.append(line)
-    return lines
+        yield f"t{function.name} {function.name}_impl;"
 
 
-def generate_dynload_calls(header, functions):
+def generate_dynload_calls(macro_prefix, functions):
     """
     Generate lines which reads all functions from dynamic library.
     """
-    macro_prefix = os.path.basename(header).replace(".h", "").upper()
-    lines = []
     for function in functions:
-        line = "  {}_LIBRARY_FIND({});" . format(
-                macro_prefix,
-                function.name)
-        lines.append(line)
-    return lines
+        yield f"  {macro_prefix}_LIBRARY_FIND({function.name});"
 
 
 def generate_extern_function_wrappers(functions):
     """
     Genrate function wrappers, which passes call to a dynload symbol.
     """
-    lines = []
     for function in functions:
-        line = ""
-        line += "{} {}" . format(formatAndCleanType(function.return_type),
-                                 function.name)
-        arguments = []
-        argument_names = []
-        for argument in function.arguments:
-            arguments.append(str(argument))
-            argument_names.append(argument.name)
-        line += "({})" . format(", " . join(arguments)) + " {\n"
-        line += "  return {}_impl({});\n" . format(
-                function.name,
-                ", " . join(argument_names))
-        line += "}\n"
-        lines.append(line)
-    return lines
+        arguments = function.arguments_declaration
+        argument_names = function.argument_names
+        yield (f"{function.return_type} {function.name}"
+               f"({arguments}) {{\n"
+               f"  return {function.name}_impl({argument_names});\n"
+               f"}}\n")
 
 
 def generate_wrapper_declarations(functions):
@@ -276,68 +298,70 @@ def generate_wrapper_declarations(functions):
     Generate wrapper function declarations.
     Those declarations actually matches functions from xcb headers.
     """
-    lines = []
     for function in functions:
-        line = ""
-        line += "{} {}" . format(formatAndCleanType(function.return_type),
-                                 function.name)
-        arguments = []
-        argument_names = []
-        for argument in function.arguments:
-            arguments.append(str(argument))
-            argument_names.append(argument.name)
-        line += "({})" . format(", " . join(arguments)) + ";"
-        lines.append(line)
-    return lines
+        arguments = function.arguments_declaration
+        yield f"{function.return_type} {function.name}({arguments});"
 
 
 def add_functions_to_wrangler(header, wrangler, functions):
-    section = ["/* " + os.path.basename(header) + " */"]
-    typedefs = section + generate_function_typedefs(functions)
-    externs = section + generate_extern_function_declarations(functions)
-    definitions = section + generate_extern_function_definitions(functions)
-    dynload = ["  " + section[0]] + generate_dynload_calls(header, functions)
-    wrappers = section + generate_extern_function_wrappers(functions)
-    wrapper_declarations = generate_wrapper_declarations(functions)
-    wrangler["functions"]["typedefs"].extend(typedefs)
-    wrangler["functions"]["wrapper_declarations"].extend(wrapper_declarations)
-    wrangler["functions"]["declarations"].extend(externs)
-    wrangler["functions"]["definitions"].extend(definitions)
-    wrangler["functions"]["dynload"].extend(dynload)
-    wrangler["functions"]["wrappers"].extend(wrappers)
+    basename = os.path.basename(header)
+    if basename.endswith(".h"):
+        macro_prefix = basename[:-2].upper()
+    else:
+        macro_prefix = basename.upper()
+    section = f"/* {basename} */"
+    group = wrangler["functions"]
+    group["typedefs"].append(section)
+    group["typedefs"].extend(generate_function_typedefs(functions))
+    group["wrapper_declarations"].extend(
+            generate_wrapper_declarations(functions))
+    group["declarations"].append(section)
+    group["declarations"].extend(
+            generate_extern_function_declarations(functions))
+    group["definitions"].append(section)
+    group["definitions"].extend(
+            generate_extern_function_definitions(functions))
+    group["dynload"].append(f"  {section}")
+    group["dynload"].extend(generate_dynload_calls(macro_prefix, functions))
+    group["wrappers"].append(section)
+    group["wrappers"].extend(generate_extern_function_wrappers(functions))
 
 
 def add_types_to_wrangler(header, wrangler, types):
-    typedefs = ["/* " + os.path.basename(header) + " */"]
-    for type in types:
-        typedefs.append(str(type) + ";\n")
-    wrangler["types"]["definitions"].extend(typedefs)
+    definitions = wrangler["types"]["definitions"]
+    definitions.append(f"/* {os.path.basename(header)} */")
+    definitions.extend(f"{type};\n" for type in types)
 
 
 def add_definitions_to_wrangler(header, wrangler, definitions):
     wrangler["definitions"]["all"].extend(definitions)
 
-def replace_template_variables(wrangler, data):
+def write_template_variables(wrangler, data, output):
     """
-    Replace variables like %foo% in template data with actual code.
+    Write template data to output, replacing variables like %foo% with actual
+    code on the fly.
     """
-    for group in wrangler:
-        for variable in wrangler[group]:
-            template_variable = "%{}_{}%" . format(group, variable)
-            data = data.replace(template_variable,
-                                "\n" . join(wrangler[group][variable]))
-    return data
+    substitutions = {f"%{group}_{variable}%": lines
+                     for group, variables in wrangler.items()
+                     for variable, lines in variables.items()}
+    pattern = re.compile("|".join(map(re.escape, substitutions)))
+    position = 0
+    for match in pattern.finditer(data):
+        output.write(data[position:match.start()])
+        output.write("\n".join(substitutions[match.group(0)]))
+        position = match.end()
+    output.write(data[position:])
 
 
 def write_wrangler_to_file(wrangler, template, destination):
     """
     Write wrangler symbols to a template.
     """
-    with open(template, "r") as input:
+    with open(template, "r", encoding="utf-8") as input:
         data = input.read()
-        data = replace_template_variables(wrangler, data)
-        with open(destination, "w") as output:
-            output.write(data)
+    # Generated code only has "\n" line endings, no need to translate them.
+    with open(destination, "w", encoding="utf-8", newline="") as output:
+        write_template_variables(wrangler, data, output)
 
 
 def write_wrangler_to_files(wrangler):
@@ -380,9 +404,14 @@ if __name__ == "__main__":
             "all": []
         },
     }
-    for header in headers:
-        functions, types, definitions = parse_file(header)
+    # Parsing is done by libclang and is independent for every header, so do
+    # it in parallel processes.
+    max_workers = min(len(headers), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        parsed_headers = list(executor.map(parse_file, headers))
+    for header, parsed_header in zip(headers, parsed_headers):
+        functions, types, definitions = parsed_header
         add_functions_to_wrangler(header, wrangler, functions)
         add_types_to_wrangler(header, wrangler, types)
         add_definitions_to_wrangler(header, wrangler, definitions)
-        write_wrangler_to_files(wrangler)
+    write_wrangler_to_files(wrangler)